@@ -61,7 +61,8 @@ setup(
     install_requires=[
         "click >= 7.0",
         "numpy >= 1.17.3",
-        "locuspocus >= 1.0.2"
+        "cyvcf2 >= 0.30.0",
+        "locuspocus >= 1.1.0"
     ],
     extras_require={"docs": []},
     include_package_data=True,
@@ -2,7 +2,7 @@
 import os
 import re
 import sys
-import gzip
+import shutil
 import signal
 import logging
 import asyncio
@@ -11,6 +11,7 @@ import subprocess
 import numpy as np
 import locuspocus as lp
 
+from cyvcf2 import VCF, Writer
 from collections import defaultdict
 from asyncio.subprocess import PIPE, STDOUT
 
@@ -23,6 +24,39 @@ logging.basicConfig()
 log = logging.getLogger('Watchdog')
 log.setLevel(logging.INFO)
 
+# Number of bytes requested from BEAGLE's STDOUT per read
+_READ_SIZE = 65536
+
+# Patterns for the BEAGLE STDOUT lines that carry window information
+_WINDOW_RE = re.compile(rb'Window \d+ \(([^:]+):(\d+)-(\d+)\)')
+_REFSAMP_RE = re.compile(rb'^Reference samples:\s+(\d+)$')
+_MARKERS_RE = re.compile(rb'^Study markers:\s+([,\d]+)$')
+# What the JVM writes to STDERR when BEAGLE runs out of heap
+_OOM_MARKER = b'java.lang.OutOfMemoryError'
+
+def _quantile(values, q):
+    '''
+        Same result as np.quantile(values, q) with linear interpolation,
+        but uses a partial sort (introselect) instead of a full sort.
+    '''
+    pos = q * (len(values) - 1)
+    k = int(pos)
+    frac = pos - k
+    if frac == 0 or k + 1 >= len(values):
+        return np.partition(values, k)[k]
+    part = np.partition(values, (k, k+1))
+    return part[k] + frac * (part[k+1] - part[k])
+
+def _info_attrs(variant):
+    '''
+        Returns the INFO field of a variant as a dict of the strings
+        written in the VCF. Flags map to an empty string.
+    '''
+    info = str(variant).split('\t', 8)[7]
+    if info == '.':
+        return {}
+    return {k: v for k,_,v in (kv.partition('=') for kv in info.split(';'))}
+
 class Watcher(object):
 
     def __init__(
@@ -67,18 +101,29 @@ class Watcher(object):
             heap_size: (default: 10g)
                 The size of the java heap. Passed 
                 to the java -Xmx parameter.
+            fltr_field: str
+                The INFO field used to score SNPs when filtering
+                a troublesome window
+            fltr_field_type: callable
+                Converts the fltr_field value into a number
+            fltr_threshold: float
+                The fraction of lowest scoring SNPs dropped each time
+                a window is filtered. SNPs without a score are dropped
+                the first time.
         '''
 
         log.info("Creating a watcher")
         # Save the original vcf name
         self.input_vcf = vcf
         # Beagle Variables
+        self._beagle_cmd = None
+        self.nthreads = nthreads
+        self._bcftools_path = shutil.which('bcftools') or 'bcftools'
         self.current_vcf = vcf
         self.out_prefix = out_prefix
         self.ref = ref
         self.window_size = window_size
         self.overlap = overlap
-        self.nthreads = nthreads
         self.heap_size = heap_size
         try:
             self.beagle_jar = os.environ['BEAGLE_JAR']
@@ -106,9 +151,19 @@ class Watcher(object):
         self.fltr_field = fltr_field
         self.fltr_field_type = fltr_field_type
         self.fltr_threshold = fltr_threshold
+        # The trouble window being filtered, kept across filter iterations
+        self._window_chrom = None
+        self._window_start = None
+        self._window_end = None
+        self._window_vcf = None
+        self._window_variants = None
+        self._window_scores = None
+        self._window_keep = None
 
         # Sub-process variable
         self.process = None
+        self._stdout_buf = bytearray()
+        self._heap_exhausted = False
         signal.signal(signal.SIGINT, self._sigint_handler)
 
         # Store information associated with windows
@@ -135,19 +190,39 @@ class Watcher(object):
         # auto-compress VCF files
         if not filename.endswith('.gz'):
             new_bgzip = tempfile.NamedTemporaryFile('w',suffix='.vcf.gz',delete=True)
-            cmd = f'bcftools view {filename} -Oz -o {new_bgzip.name}'.split(' ')
             log.info(f"[ WD ]: compressing {filename} into {new_bgzip.name}")
-            window = subprocess.run(
-                cmd, capture_output=True, encoding='utf-8',text=True
-            )
+            self._bcftools('view', filename, '-Oz', '-o', new_bgzip.name)
             log.info(f"[ WD ]: Closing {filename}")
         else:
             new_bgzip = new_value
 
         self._current_vcf = new_bgzip
+        # The BEAGLE command needs to point at the new VCF
+        self._beagle_cmd = None
         # In order to use bcftools, the VCF file needs to be indexed
         self._index_current_vcf()
 
+    @property
+    def heap_size(self):
+        return self._heap_size
+
+    @heap_size.setter
+    def heap_size(self,new_value):
+        self._heap_size = new_value
+        # The BEAGLE command needs the new -Xmx value
+        self._beagle_cmd = None
+
+    async def set_current_vcf(self,new_value):
+        '''
+            Sets current_vcf from within the event loop. Any compressing
+            and indexing done by bcftools runs in a worker thread instead
+            of blocking the loop.
+        '''
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None, setattr, self, 'current_vcf', new_value
+        )
+
     def _sigint_handler(self,sig,frame):
         '''
             What to do when we get in INTERRUPT signal
@@ -183,7 +258,10 @@ class Watcher(object):
     def beagle_command(self):
         '''
             Create the command string based on the variables passed in.
+            The command is cached until the heap size or VCF changes.
         '''
+        if self._beagle_cmd is not None:
+            return self._beagle_cmd
         cmd = [
             'java', f'-Xmx{self.heap_size}', '-jar', self.beagle_jar,  
             f'gt={self.current_vcf}', f'out={self.out_prefix}', f'impute=true', 
@@ -193,6 +271,7 @@ class Watcher(object):
         # if we are imputing, insert the ref vcf
         if self.ref is not None:
             cmd.insert(5,f'ref={self.ref}')
+        self._beagle_cmd = cmd
         return cmd
 
 
@@ -205,70 +284,140 @@ class Watcher(object):
             killed.
         '''
         # Run the BEAGLE command in a subprocess
-        log.info(f"[ WD ]: Executing the following command: {' '.join(self.beagle_command)}")
+        log.info("[ WD ]: Executing the following command: %s", ' '.join(self.beagle_command))
         self.process = await asyncio.create_subprocess_exec(
             *self.beagle_command,
             stdout=PIPE,
             stderr=PIPE
         ) 
-        # Monitor the STDOUT and detect a timeout 
-        while True:
-            try:
-                line = await asyncio.wait_for(
-                    self.process.stdout.readline(), 
-                    self.check_every
+        self._stdout_buf = bytearray()
+        self._heap_exhausted = False
+        # STDERR is read alongside STDOUT so the pipe can never fill up
+        stderr_task = asyncio.create_task(self._drain_stderr(self.process.stderr))
+        # A single pending read and a single pending exit are watched for
+        # the whole run instead of re-creating a timeout per read
+        read_task = asyncio.create_task(self.process.stdout.read(_READ_SIZE))
+        exit_task = asyncio.create_task(self.process.wait())
+        watching = {read_task, exit_task}
+        try:
+            # Monitor the STDOUT and detect a timeout 
+            while True:
+                done, _ = await asyncio.wait(
+                    watching, 
+                    timeout=self.check_every,
+                    return_when=asyncio.FIRST_COMPLETED
                 )
-                # A Line has been produced. Extract any information from it.
-                if not line:
-                    break # End of File
+                if not done:
+                    # Add the total amount of time waited
+                    self.total_waiting += self.check_every
+                    log.info(
+                        "[ WD ]: TIMED OUT WAITING FOR UPDATE, "
+                        "HAVE WAITED FOR %s SECONDS", self.total_waiting
+                    )
+                    if  self.total_waiting >= self.timeout:
+                        # Its timed out
+                        log.info(
+                            "[ WD ]: BEAGLE TIMED OUT PROCESSING %s", self.cur_window
+                        )
+                        self.process.kill()
+                        # Remove the temp output files
+                        if os.path.exists(self.out_prefix+'.vcf.gz'):
+                            os.remove(self.out_prefix+'.vcf.gz')
+                        if os.path.exists(self.out_prefix+'.log'):
+                            os.remove(self.out_prefix+'.log')
+                        raise BeagleTimeoutError()
+                    continue
+                # BEAGLE may exit before all of its output has been read,
+                # keep reading STDOUT until the End of File
+                if exit_task in done:
+                    watching.discard(exit_task)
+                if read_task not in done:
+                    continue
+                chunk = read_task.result()
+                # Output has been produced. Extract any information from it.
+                if not chunk:
+                    # End of File, flush out any trailing partial line
+                    lines = [bytes(self._stdout_buf)] if self._stdout_buf else []
                 else:
-                    line = line.decode()
+                    lines = self._split_stdout(chunk)
+                # Lines stay as bytes, only decode them if they get logged
+                log_lines = log.isEnabledFor(logging.INFO)
+                for line in lines:
                     self._parse_current_info(line)
-                    # reset the timeout
-                    self.total_waiting = 0
                     # Print the output
-                    log.info(f"[ WD ]: {line.strip()}")
-                    # continue the loop
-                    continue
-            except asyncio.TimeoutError as e:
-                # Add the total amount of time waited
-                self.total_waiting += self.check_every
-                log.info(
-                    f"[ WD ]: TIMED OUT WAITING FOR UPDATE, "
-                    f"HAVE WAITED FOR {self.total_waiting} SECONDS"
-                )
-                if  self.total_waiting >= self.timeout:
-                    # Its timed out
-                    log.info(
-                        f"[ WD ]: BEAGLE TIMED OUT PROCESSING {self.cur_window}"
-                    )
-                    self.process.kill()
-                    # Remove the temp output files
-                    if os.path.exists(self.out_prefix+'.vcf.gz'):
-                        os.remove(self.out_prefix+'.vcf.gz')
-                    if os.path.exists(self.out_prefix+'.log'):
-                        os.remove(self.out_prefix+'.log')
-                    raise BeagleTimeoutError()
-        # wait for the child to exit
-        await self.process.wait()
+                    if log_lines:
+                        log.info("[ WD ]: %s", line.decode('ascii','replace').strip())
+                if not chunk:
+                    break
+                # reset the timeout
+                self.total_waiting = 0
+                watching.discard(read_task)
+                read_task = asyncio.create_task(self.process.stdout.read(_READ_SIZE))
+                watching.add(read_task)
+            # wait for the child to exit
+            await exit_task
+            await stderr_task
+            if self._heap_exhausted:
+                raise BeagleHeapError()
+        finally:
+            # Don't leave reads pending if BEAGLE was killed or errored
+            read_task.cancel()
+            exit_task.cancel()
+            stderr_task.cancel()
         self.process = None
         # return the code
         return True
 
+    async def _drain_stderr(self,stream):
+        '''
+            Reads BEAGLE's STDERR as it is produced. If the JVM reports
+            running out of heap, BEAGLE is killed right away and
+            watch_beagle raises a BeagleHeapError once it has exited.
+        '''
+        # keep the end of the previous read in case the marker is
+        # split across two reads
+        tail = b''
+        while True:
+            chunk = await stream.read(_READ_SIZE)
+            if not chunk:
+                return
+            if _OOM_MARKER in chunk or _OOM_MARKER in tail + chunk[:len(_OOM_MARKER)]:
+                log.info("[ WD ]: BEAGLE RAN OUT OF HEAP SPACE")
+                self._heap_exhausted = True
+                self.process.kill()
+                return
+            tail = chunk[-len(_OOM_MARKER):]
+
+    def _split_stdout(self,chunk):
+        '''
+            Append a chunk of BEAGLE output to the STDOUT buffer and
+            return the completed lines. Any trailing partial line is
+            left in the buffer until the rest of it is read.
+        '''
+        buf = self._stdout_buf
+        buf += chunk
+        end = buf.rfind(b'\n')
+        if end < 0:
+            return []
+        with memoryview(buf) as view:
+            lines = view[:end].tobytes().split(b'\n')
+        del buf[:end+1]
+        return lines
+
     def _parse_current_info(self,line):
         # Extract window infromation
-        if line.startswith('Window'):
-            window = re.match('Window \d+ \(([^:]+):(\d+)-(\d+)\)',line)
-            self.cur_window_chrom = window[1]
+        if line.startswith(b'Window'):
+            window = _WINDOW_RE.match(line)
+            self.cur_window_chrom = window[1].decode()
             self.cur_window_start = int(window[2])
             self.cur_window_end = int(window[3])
-        elif line.startswith('Reference samples:'):
-            num_samples = re.match('^Reference samples:\s+(\d+)$',line)
+        elif line.startswith(b'Reference samples:'):
+            num_samples = _REFSAMP_RE.match(line)
             self.num_reference_samples = int(num_samples[1])
-        elif line.startswith('Study markers:'):
-            num_markers = re.match('^Study markers:\s+([,\d]+)$',line)
-            self.cur_window_num_markers = int(num_markers[1].replace(',',''))
-        elif line.startswith('ERROR: java.lang.OutOfMemoryError:'):
+        elif line.startswith(b'Study markers:'):
+            num_markers = _MARKERS_RE.match(line)
+            self.cur_window_num_markers = int(num_markers[1].replace(b',',b''))
+        elif line.startswith(b'ERROR: java.lang.OutOfMemoryError:'):
             raise BeagleHeapError
         else:
             # The line contains no parseable information
@@ -276,14 +425,54 @@ class Watcher(object):
 
     def _index_current_vcf(self):
         '''
-            A convenience method to index the current VCF file
+            A convenience method to index the current VCF file. An
+            existing index is reused as long as it is newer than the VCF.
         '''
-        if not os.path.exists(self.current_vcf+'.csi'):
+        index = self.current_vcf+'.csi'
+        if (
+            not os.path.exists(index) 
+            or os.path.getmtime(index) < os.path.getmtime(self.current_vcf)
+        ):
             log.info(f"[ WD ]: Indexing {self.current_vcf}")
-            cmd = f'bcftools index {self.current_vcf}'.split(' ')
-            index = subprocess.run(
-                cmd, capture_output=True
-            )  
+            self._bcftools('index', '-f', self.current_vcf)
+
+    def _bcftools(self,*args):
+        '''
+            Runs a bcftools command using nthreads htslib compression
+            threads. Nothing is buffered in memory, STDERR is only shown
+            when debugging. Raises CalledProcessError if bcftools fails.
+        '''
+        cmd = [self._bcftools_path, *args, '--threads', str(self.nthreads)]
+        stderr = None if log.isEnabledFor(logging.DEBUG) else subprocess.DEVNULL
+        # With an absolute path and close_fds=False subprocess can use
+        # posix_spawn instead of forking this (possibly large) process
+        proc = subprocess.Popen(
+            cmd, stdout=subprocess.DEVNULL, stderr=stderr, close_fds=False
+        )
+        returncode = proc.wait()
+        if returncode != 0:
+            log.error(
+                "[ WD ]: '%s' failed with exit code %s "
+                "(run with DEBUG logging to see its output)",
+                ' '.join(cmd), returncode
+            )
+            raise subprocess.CalledProcessError(returncode, cmd)
+
+    def _region(self,chromosome=None,start=None,end=None):
+        '''
+            Builds an htslib region string, defaulting to the current
+            window for any bound that is not specified.
+        '''
+        # If not specified, assume current window
+        if chromosome is None:
+            chromosome = self.cur_window_chrom
+        if start is None:
+            start = self.cur_window_start
+        if end is None:
+            end = self.cur_window_end
+        # make sure start is positive
+        start = max(0,start)
+        return f'{chromosome}:{start}-{end}'
 
     async def current_vcf_lines(
         self,
@@ -300,101 +489,142 @@ class Watcher(object):
             >>> [l async for l in x.current_vcf_lines('chr1',1,1000,header=True)]
 
         '''
-        # If not specified, assume current window
-        if chromosome is None:
-            chromosome = self.cur_window_chrom
-        if start is None:
-            start = self.cur_window_start
-        if end is None:
-            end = self.cur_window_end
-        # make sure start is positive
-        start = max(0,start)
-        if not header:
-            header_flag = '-H'
-        else:
-            header_flag = ''
-        # Extract the header for the VCF file
-        cmd = f'bcftools view {header_flag} {self.current_vcf} -r {chromosome}:{start}-{end}'
-        log.info(f'[ WD ]: Executing: {cmd}')
-        proc = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
+        region = self._region(chromosome,start,end)
+        log.info(f'[ WD ]: Fetching {region} from {self.current_vcf}')
+        # htslib does the region query in a worker thread so the
+        # event loop is not blocked
+        loop = asyncio.get_running_loop()
+        lines = await loop.run_in_executor(
+            None, self._fetch_vcf_lines, region, header
         )
-        while not proc.stdout.at_eof():
-            line = await proc.stdout.readline()
-            line = line.decode('utf-8').strip()
-            if line != '':
-                yield line 
+        for line in lines:
+            yield line
+
+    def _fetch_vcf_lines(self,region,header=False):
+        '''
+            Returns the lines of the current VCF file within region,
+            optionally preceded by the header lines.
+        '''
+        vcf = VCF(self.current_vcf)
+        lines = []
+        if header:
+            lines.extend(vcf.raw_header.rstrip('\n').split('\n'))
+        lines.extend(str(v).rstrip('\n') for v in vcf(region))
+        vcf.close()
+        return lines
 
     async def split_out_current_window(self):
         '''
             Split out the current window and filter out the lowest
-            scores SNPs based on self.fltr_threshold
+            scores SNPs based on self.fltr_threshold. The window is only
+            parsed once, repeated calls drop the lowest scoring SNPs of
+            those kept by the previous call.
 
             Returns
             -------
             A NamedTemporaryFile containing passing SNPs from current window
         '''
         # Create a temp file to store the new VCF SNPs
-        bad_window_vcf = tempfile.NamedTemporaryFile('w',suffix='.vcf',delete=True) 
-        # Filter out the lowest x% of scores
-        scores = []
-        lines = []
-        # pull out SNPs in the current window along with their scores
-        for line in [l async for l in self.current_vcf_lines(header=True)]:
-            if line.startswith('#'):
-                print(line,file=bad_window_vcf,flush=True)
-            else:
-                lines.append(line)
-                info_fields = line.split('\t')[7].split(';') 
-                for k,v in map(lambda x: x.split('='), info_fields):
-                    if k == self.fltr_field:
-                        scores.append(self.fltr_field_type(v))
-        # Figure out the threshold for the lowest X%
-        quantile_cutoff = np.quantile(scores, self.fltr_threshold)
+        bad_window_vcf = tempfile.NamedTemporaryFile('w',suffix='.vcf.gz',delete=True) 
+        if self._window_vcf is None:
+            # pull out SNPs in the current window along with their scores,
+            # later iterations only drop more SNPs from this same set
+            self._window_chrom = self.cur_window_chrom
+            self._window_start = self.cur_window_start
+            self._window_end = self.cur_window_end
+            self._window_vcf = VCF(self.current_vcf)
+            self._window_variants = [
+                v for v in self._window_vcf(self.cur_window)
+                if self._window_start <= v.POS <= self._window_end
+            ]
+            self._window_scores = np.fromiter(
+                map(self._score, self._window_variants),
+                dtype=np.float64,
+                count=len(self._window_variants)
+            )
+            self._window_keep = np.ones(len(self._window_variants), dtype=bool)
+        vcf = self._window_vcf
+        variants = self._window_variants
+        scores = self._window_scores
+        keep_mask = self._window_keep
+        num_remaining = np.count_nonzero(keep_mask)
+        # Figure out the threshold for the lowest X% of the remaining SNPs
+        remaining = scores[keep_mask]
+        scored = remaining[~np.isnan(remaining)]
+        if len(scored) > 0:
+            quantile_cutoff = _quantile(scored, self.fltr_threshold)
+        else:
+            quantile_cutoff = np.inf
         log.info(f"[ WD ]: Filtering out the bottom {self.fltr_threshold*100}% of variants")
-        num_dropped = 0
-        # Filter out the lowest X percent of SNPs and add filtered out SNPs
-        # as Locus objects to self.dropped_loci
-        for line,score in zip(lines,scores):
-            if score >= quantile_cutoff:
-                # Print the vcf record into the new filtered_vcf file
-                print(line, file=bad_window_vcf,flush=True)
-            else:
-                num_dropped += 1
-                # Create a locus object and add to the filtered list
-                v = line.split('\t')[0:8]
-                locus = lp.Locus(
-                    chromosome=v[0],
-                    start=int(v[1]),
-                    end=int(v[1]),
-                    feature_type='SNP',
-                    source=self.input_vcf
-                )
-                # Add a name if available
-                if v[2] != '.':
-                    locus.name = v[2]
-                # Add attrs
-                for k,v in map(lambda x: x.split('='), v[7].split(';')):
-                    locus[k] = v
-                self.loci.add_locus(locus)
-        log.info(f"[ WD ]: Dropped a total of {num_dropped} of {len(lines)} SNPs in {self.cur_window}")
+        # NaN never compares as >= so SNPs without a score are dropped too
+        drop_mask = keep_mask & ~(scores >= quantile_cutoff)
+        keep_mask &= ~drop_mask
+        keep_idx = np.flatnonzero(keep_mask)
+        drop_idx = np.flatnonzero(drop_mask)
+        num_dropped = len(drop_idx)
+        # Write the passing vcf records into the new filtered_vcf file
+        writer = Writer(bad_window_vcf.name, vcf, mode='wz')
+        for i in keep_idx:
+            writer.write_record(variants[i])
+        # Add filtered out SNPs as Locus objects to self.loci in one batch
+        Locus = lp.Locus
+        source = self.input_vcf
+        dropped = [
+            Locus(
+                chromosome=v.CHROM,
+                start=v.POS,
+                end=v.POS,
+                feature_type='SNP',
+                source=source,
+                name=v.ID,
+                attrs=_info_attrs(v)
+            )
+            for v in map(variants.__getitem__, drop_idx)
+        ]
+        # Loci has no batch insert, share one transaction between inserts
+        with self.loci.m80.db.bulk_transaction() as cur:
+            for locus in dropped:
+                self.loci.add_locus(locus, cur=cur)
+        writer.close()
+        log.info(f"[ WD ]: Dropped a total of {num_dropped} of {num_remaining} SNPs in {self.cur_window}")
 
         return bad_window_vcf
 
+    def _score(self,variant):
+        '''
+            Returns the filter score of a variant, NaN if it has none
+        '''
+        value = variant.INFO.get(self.fltr_field)
+        if value is None:
+            return np.nan
+        return self.fltr_field_type(value)
+
+    def _close_window(self):
+        '''
+            Forget the trouble window kept by split_out_current_window
+        '''
+        if self._window_vcf is not None:
+            self._window_vcf.close()
+        self._window_chrom = None
+        self._window_start = None
+        self._window_end = None
+        self._window_vcf = None
+        self._window_variants = None
+        self._window_scores = None
+        self._window_keep = None
+
     async def filter_window(self):
         '''
             Returns a named temp file containing the filtered VCF. 
         '''
-        filtered_vcf = tempfile.NamedTemporaryFile('w',suffix='.vcf',delete=True) 
+        filtered_vcf = tempfile.NamedTemporaryFile('w',suffix='.vcf.gz',delete=True) 
         log.info(f"[ WD ]: Filtering VCF into: {filtered_vcf.name}")
 
         old_vcf = self._current_vcf
         # Create loop to filter down the trouble window
         while True:
             # new VCF with lowest 5% of SNPs filtered out
-            self.current_vcf = await self.split_out_current_window()
+            await self.set_current_vcf(await self.split_out_current_window())
             try:
                 phase_success = await self.watch_beagle()
                 if phase_success:
@@ -408,24 +638,43 @@ class Watcher(object):
                 self.heap_size = str(old_heap_size + 10) + 'g'
         
         good_window = self._current_vcf
-        self.current_vcf = old_vcf
+        await self.set_current_vcf(old_vcf)
+        # Splice on the window that was filtered, BEAGLE overwrites the
+        # cur_window_* variables while phasing the filtered window
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None, self._write_filtered_vcf, filtered_vcf.name, good_window.name,
+            self._window_chrom, self._window_start, self._window_end
+        )
+        self._close_window()
+        await self.set_current_vcf(filtered_vcf)
+
+    def _write_filtered_vcf(self,filename,good_window,chromosome,start,end):
+        '''
+            Writes the current VCF into filename as a bgzipped VCF, with
+            the SNPs of chromosome between start and end replaced by 
+            those in good_window.
+        '''
+        vcf = VCF(self.current_vcf)
+        writer = Writer(filename, vcf, mode='wz')
         log.info(f"[ WD ]: Printing SNPs up to troublesome window")
         # print the header and all SNPs up to the window 
-        async for line in self.current_vcf_lines(end=self.cur_window_start-1, header=True):
-            print(line, file=filtered_vcf, flush=True)
-        
+        for v in vcf(self._region(chromosome,0,start-1)):
+            # region queries also return records overlapping the bounds
+            if v.POS < start:
+                writer.write_record(v)
+
         log.info(f"[ WD ]: Printing goods SNPs within troublesome window")
         # print out the SNPs in the good window
-        with gzip.open(good_window.name,'rt') as IN:
-            for line in IN:
-                if line.startswith('#'):
-                    continue
-                else:
-                    print(line, file=filtered_vcf, flush=True)
+        good_vcf = VCF(good_window)
+        for v in good_vcf:
+            writer.write_record(v)
+        good_vcf.close()
 
         log.info(f"[ WD ]: Printing the rest of SNPs")
         # Process the rest ------------------------------------------------
-        async for line in self.current_vcf_lines(start=self.cur_window_end+1,end=''):
-            print(line, file=filtered_vcf, flush=True)
-        
-        self.current_vcf = filtered_vcf
+        for v in vcf(self._region(chromosome,end+1,'')):
+            if v.POS > end:
+                writer.write_record(v)
+        writer.close()
+        vcf.close()